@@ -3,12 +3,14 @@
 import ast
 import logging
 import os
+import Queue
 import threading
 import time
 
 import docker
 import numpy as np
 from docker.errors import *
+from docker.utils import parse_repository_tag
 
 __author__ = 'Nikitas Papangelopoulos'
 
@@ -18,6 +20,19 @@ logger = logging.getLogger(__name__)
 SAVE_MONITORING = True
 # A boolean to print the raw output of the to generator from stats().
 RAW_MONITORING = False
+# The number of NUMA nodes of the docker host. The docker api does not expose the topology, so the cores reported by
+# the server are split evenly into this many contiguous nodes.
+NUMA_NODES = 1
+# The number of records each subscriber to the stats and logs streams can buffer before the oldest ones are dropped.
+SUBSCRIBER_BUFFER_SIZE = 1000
+# The number of seconds a subscriber waits for a record before checking again, so that it can still be interrupted.
+SUBSCRIBER_POLL_INTERVAL = 0.5
+
+# The streams that can be subscribed to. 'pulls' delivers the per-layer progress of the image pulls.
+STREAMS = ('stats', 'logs', 'pulls')
+
+# The marker that ends the iteration of a closed subscription.
+_END_OF_STREAM = object()
 
 
 class ContainerManager(object):
@@ -27,6 +42,16 @@ class ContainerManager(object):
         """
         self.__image_dict = {}
         self.__container_dict = {}
+        self.__core_allocator = None
+        # Guards the core allocator, as containers can be created from the threads of the image pulls.
+        self.__placement_lock = threading.RLock()
+        self.__subscriptions = []
+        self.__subscription_lock = threading.Lock()
+        self.__console_subscriptions = []
+        self.__monitoring_file = None
+        self.__monitoring_subscription = None
+        self.__pulls = {}
+        self.__pull_lock = threading.Lock()
 
         # Checking if the required environment variables are in the system path
         if {'DOCKER_HOST', 'DOCKER_TLS_VERIFY', 'DOCKER_CERT_PATH'}.issubset(os.environ.keys()):
@@ -44,16 +69,23 @@ class ContainerManager(object):
                 logger.error('Missing environment variables from system path. Failed to create the docker client.\n '
                              'Please run "docker-machine env <machine-name>"')
 
-    def build_image(self, path, tag):
+    def build_image(self, path, tag, warm_base_images=True):
         """
         A method to create a docker image from a folder containing a Dockerfile.
         :param path: The path to the folder that contains the Dockerfile.
         :type path: str
         :param tag: The tag to assign to the image.
         :type tag: str
+        :param warm_base_images: A boolean to pull the base images of the Dockerfile concurrently before the build,
+        instead of one after the other inside it.
+        :type warm_base_images: bool
         :return: The created docker image.
         :rtype: DockerImage
         """
+        if warm_base_images:
+            for reference, pull in self.warm_images(dockerfile_base_images(path)).items():
+                if not pull.wait():
+                    logger.warning('Unable to warm base image: {}, the build will pull it itself.'.format(reference))
         docker_image = DockerImage(self.docker_client, path, tag)
         self.__image_dict[docker_image.id] = docker_image
         return docker_image
@@ -64,7 +96,7 @@ class ContainerManager(object):
         :param image_id: TThe image ID to retrieve.
         :type image_id: str
         :return: The docker image.
-        :rtype: DockerImage || None
+        :rtype: DockerImage || PulledImage || None
         """
         try:
             logger.debug('Retrieved image: ' + image_id)
@@ -87,6 +119,11 @@ class ContainerManager(object):
             # Also removing from the client
             self.docker_client.images.remove(image_id)
             logger.debug('Removed image: ' + image_id)
+            # Forgetting the pulls of the image, so that it is pulled again when requested.
+            with self.__pull_lock:
+                for reference, pull in self.__pulls.items():
+                    if pull.image is not None and pull.image.id == image_id:
+                        del self.__pulls[reference]
             return True
         except KeyError:
             logger.error('Unable to remove image: {}. It was not found.'.format(image_id))
@@ -95,36 +132,200 @@ class ContainerManager(object):
 
     def available_images(self):
         """
-        A method to return the dictionary of all available images that were created by the container manager.
-        :return: A dictionary image_id:DockerImage
+        A method to return the dictionary of all available images that were created or pulled by the container manager.
+        :return: A dictionary image_id:DockerImage || PulledImage
         :rtype: dict
         """
         return self.__image_dict
 
-    def create_container(self, image_id, name='', port=None):
+    def core_allocator(self):
+        """
+        A method to return the allocator that places containers on the cores of the docker host. It is created on first
+        use, with the number of cores reported by the docker server.
+        :return: The core allocator.
+        :rtype: CoreAllocator
+        """
+        with self.__placement_lock:
+            if self.__core_allocator is None:
+                core_count = self.docker_client.info().get('NCPU', 1)
+                self.__core_allocator = CoreAllocator(core_count, NUMA_NODES)
+                logger.debug('Created core allocator for {} cores on {} NUMA node(s).'.format(core_count, NUMA_NODES))
+            return self.__core_allocator
+
+    def pull_image(self, reference, force=False):
+        """
+        A method to pull an image in a separate thread. Requests for a reference that is already being pulled, or that
+        was pulled successfully, return the same ImagePull instead of pulling it again. Images that are available
+        locally are not pulled. The per-layer progress is published to the 'pulls' subscribers.
+        :param reference: The image to pull, e.g. 'flask', 'flask:latest' or 'localhost:5000/flask:v1'.
+        :type reference: str
+        :param force: A boolean to pull the image again even if it was already pulled or is available locally.
+        :type force: bool
+        :return: The pull of the image.
+        :rtype: ImagePull
+        """
+        reference = normalize_reference(reference)
+        with self.__pull_lock:
+            cached = self.__pulls.get(reference)
+            if cached and not cached.done():
+                logger.debug('Image: {} is already being pulled.'.format(reference))
+                return cached
+        # A finished pull is only reused if the image was not removed from the server since.
+        if cached and cached.image is not None and not force and self.__refresh_pull(cached):
+            logger.debug('Image: {} is already pulled.'.format(reference))
+            return cached
+        with self.__pull_lock:
+            current = self.__pulls.get(reference)
+            if current is not cached and current is not None and not current.done():
+                return current
+            pull = ImagePull(self.docker_client, reference, lambda record: self.publish('pulls', record), force)
+            self.__pulls[reference] = pull
+        pull.add_done_callback(self.__register_pull)
+        pull.start()
+        return pull
+
+    def __refresh_pull(self, pull):
+        try:
+            pull.image = self.docker_client.images.get(pull.reference)
+            return True
+        except ImageNotFound:
+            logger.info('Image: {} was removed from the server, pulling it again.'.format(pull.reference))
+            for image_id, image in self.__image_dict.items():
+                if isinstance(image, PulledImage) and image.tag == pull.reference:
+                    del self.__image_dict[image_id]
+            return False
+
+    def __register_pull(self, pull):
+        if pull.image is not None:
+            pulled_image = PulledImage(pull.image, pull.reference)
+            self.__image_dict[pulled_image.id] = pulled_image
+
+    def warm_images(self, references, force=False):
+        """
+        A method to pull a list of images concurrently. Each distinct image is pulled only once.
+        :param references: The images to pull.
+        :type references: list
+        :param force: A boolean to pull the images again even if they were already pulled.
+        :type force: bool
+        :return: A dictionary reference:ImagePull.
+        :rtype: dict
+        """
+        return dict((reference, self.pull_image(reference, force)) for reference in references)
+
+    def create_container_when_ready(self, reference, name='', port=None, resource_profile=None, callback=None):
+        """
+        A method to create a container as soon as its image is pulled, without waiting for any other pull.
+        :param reference: The image to pull and create the container from.
+        :type reference: str
+        :param name: A name to give to the container. Optional.
+        :type name: str
+        :param port: The port to map to the container web_app. Optional
+        :type port: int
+        :param resource_profile: The CPU and memory limits of the container. Optional
+        :type resource_profile: ResourceProfile
+        :param callback: A function that is called with the created container, or None if the pull or the creation
+        failed. Optional.
+        :type callback: function
+        :return: The pull of the image.
+        :rtype: ImagePull
+        """
+        def create(pull):
+            container = None
+            if pull.image is not None:
+                container = self.create_container(pull.image.id, name, port, resource_profile)
+            if callback:
+                callback(container)
+
+        pull = self.pull_image(reference)
+        pull.add_done_callback(create)
+        return pull
+
+    def create_container(self, image_id, name='', port=None, resource_profile=None):
         """
         A method to create a docker container based on a specific image. If no port is provided the default 5000 will
-        be used by the DockerContainer constructor.
+        be used by the DockerContainer constructor. If a resource profile asks for a number of cores, they are chosen
+        by the core allocator so that the replicas are spread evenly across the host. Cores given explicitly with
+        cpuset_cpus are recorded by the allocator but never moved.
         :param image_id: The image ID to use for creating the container.
         :type image_id: str
         :param name: A name to give to the container. Optional.
         :type name: str
         :param port: The port to map to the container web_app. Optional
         :type port: int
+        :param resource_profile: The CPU and memory limits of the container. Optional
+        :type resource_profile: ResourceProfile
         :return: The container that was created or None, if there was an error during creation.
         :rtype: DockerContainer || None
         """
+        if resource_profile:
+            # Choosing, creating and assigning the cores in one step, so that concurrent creations see each other.
+            with self.__placement_lock:
+                return self.__create_container(image_id, name, port, resource_profile)
+        return self.__create_container(image_id, name, port, resource_profile)
+
+    def __create_container(self, image_id, name, port, resource_profile):
+        cores = []
+        pinned = False
+        resources = {}
+        if resource_profile:
+            if resource_profile.cpuset_cpus:
+                cores = CoreAllocator.parse_cpuset(resource_profile.cpuset_cpus)
+                pinned = True
+            elif resource_profile.cpus:
+                cores = self.core_allocator().allocate(resource_profile.cpus)
+            resources = resource_profile.create_kwargs([] if pinned else cores, self.__core_allocator)
+
         if port:
-            container = DockerContainer(self.docker_client, image_id, name, port)
+            container = DockerContainer(self.docker_client, image_id, name, port, resources)
         else:
-            container = DockerContainer(self.docker_client, image_id, name
-                                        )
+            container = DockerContainer(self.docker_client, image_id, name, resources=resources)
         if container.created_successfully:
             self.__container_dict[container.id] = container
+            if cores:
+                self.core_allocator().assign(container.id, cores, pinned)
+                self.rebalance_containers()
             return container
         else:
             return None
 
+    def rebalance_containers(self):
+        """
+        A method to even out the load on the cores of the docker host, after containers were added or removed. The
+        containers that are moved by the core allocator get their cpuset, and on NUMA hosts their memory nodes,
+        updated in place, without being restarted.
+        :return: A dictionary container_id:cpuset of the containers that were moved.
+        :rtype: dict
+        """
+        with self.__placement_lock:
+            return self.__rebalance_containers()
+
+    def __rebalance_containers(self):
+        if self.__core_allocator is None:
+            return {}
+        previous = self.__core_allocator.assignments()
+        moved = {}
+        for container_id, cores in self.__core_allocator.rebalance().items():
+            cpuset = CoreAllocator.cpuset(cores)
+            # Moving the memory along with the cores, so that a replica never runs on a NUMA node away from its memory.
+            cpuset_mems = self.__core_allocator.cpuset_mems(cores)
+            update_kwargs = {'cpuset_cpus': cpuset}
+            if cpuset_mems is not None:
+                update_kwargs['cpuset_mems'] = cpuset_mems
+            try:
+                self.docker_client.containers.get(container_id).update(**update_kwargs)
+            except APIError, e:
+                logger.error('Error while moving container: {}. Error message: {}'.format(container_id, e))
+                # Keeping the allocator in line with the cores the container actually uses.
+                self.__core_allocator.assign(container_id, previous[container_id])
+                continue
+            container = self.__container_dict.get(container_id)
+            if container is not None:
+                container.cpuset = cpuset
+                container.cpuset_mems = cpuset_mems
+            moved[container_id] = cpuset
+            logger.debug('Moved container: {} to cores: {}'.format(container_id, cpuset))
+        return moved
+
     def start_container(self, container_id):
         """
         A method to start the docker container of the specified container ID. It also updates the status of the
@@ -190,6 +391,9 @@ class ContainerManager(object):
             # Also removing from the client
             self.docker_client.containers.remove(container_id)
             logger.debug('Removed container: ' + container_id)
+            with self.__placement_lock:
+                if self.__core_allocator is not None and self.__core_allocator.release(container_id):
+                    self.rebalance_containers()
             return True
         except (ValueError, APIError), e:
             logger.error('Error while removing container: ' + str(e))
@@ -232,12 +436,121 @@ class ContainerManager(object):
         return [(container.name, container.id) for container in self.docker_client.containers.list() if
                 container.status == 'running']
 
-    def monitoring_logging_start(self):
+    def subscribe(self, callback=None, stream='stats', record_filter=None, maxsize=None):
+        """
+        A method to subscribe to the records of the stats or logs streams. Each subscription has its own bounded buffer,
+        so that a slow consumer drops its oldest records instead of stalling the streams. If a callback is given, it is
+        called with every record from a separate thread, otherwise the records can be read by iterating the returned
+        subscription.
+        :param callback: A function that takes a record as its only argument. Optional.
+        :type callback: function
+        :param stream: The stream to subscribe to, 'stats', 'logs' or 'pulls'.
+        :type stream: str
+        :param record_filter: A function that takes a record and returns True if it should be delivered. Optional.
+        :type record_filter: function
+        :param maxsize: The number of records to buffer. If none, SUBSCRIBER_BUFFER_SIZE is used.
+        :type maxsize: int
+        :return: The subscription.
+        :rtype: Subscription
+        """
+        if stream not in STREAMS:
+            raise ValueError('Unknown stream: {}. Available streams are: {}.'.format(stream, ', '.join(STREAMS)))
+        subscription = Subscription(stream, record_filter, maxsize or SUBSCRIBER_BUFFER_SIZE)
+        with self.__subscription_lock:
+            self.__subscriptions.append(subscription)
+        if callback:
+            callback_thread = threading.Thread(target=self.__callback_worker, args=(subscription, callback))
+            callback_thread.daemon = True
+            callback_thread.start()
+        logger.debug('Added subscription to the {} stream.'.format(stream))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        A method to remove a subscription. Iterating it, or its callback thread, stops after the buffered records.
+        :param subscription: The subscription returned by subscribe().
+        :type subscription: Subscription
+        :return: A boolean signifying if the subscription was removed.
+        :rtype: bool
+        """
+        with self.__subscription_lock:
+            if subscription not in self.__subscriptions:
+                return False
+            self.__subscriptions.remove(subscription)
+        subscription.close()
+        logger.debug('Removed subscription to the {} stream.'.format(subscription.stream))
+        return True
+
+    def iter_stats(self, container_id=None, maxsize=None):
+        """
+        A method to return an iterator of the stats records of the monitored containers. The subscription is made
+        immediately and is removed when the iterator is closed, exhausted or garbage collected.
+        :param container_id: Only yield the records of this container. Optional.
+        :type container_id: str
+        :param maxsize: The number of records to buffer. Optional.
+        :type maxsize: int
+        :return: An iterator of stats records.
+        :rtype: SubscriptionIterator
+        """
+        return self.__iter_stream('stats', container_id, maxsize)
+
+    def iter_logs(self, container_id=None, maxsize=None):
+        """
+        A method to return an iterator of the log records of the monitored containers. The subscription is made
+        immediately and is removed when the iterator is closed, exhausted or garbage collected.
+        :param container_id: Only yield the records of this container. Optional.
+        :type container_id: str
+        :param maxsize: The number of records to buffer. Optional.
+        :type maxsize: int
+        :return: An iterator of log records.
+        :rtype: SubscriptionIterator
+        """
+        return self.__iter_stream('logs', container_id, maxsize)
+
+    def __iter_stream(self, stream, container_id, maxsize):
+        record_filter = None
+        if container_id:
+            record_filter = lambda record: record['container_id'] == container_id
+        return SubscriptionIterator(self, self.subscribe(stream=stream, record_filter=record_filter, maxsize=maxsize))
+
+    def __callback_worker(self, subscription, callback):
+        for record in subscription:
+            try:
+                callback(record)
+            except Exception:
+                logger.exception('Error in the {} subscriber {}.'.format(subscription.stream, callback))
+
+    def publish(self, stream, record):
+        """
+        A method to deliver a record to every subscription of a stream whose filter accepts it.
+        :param stream: The stream of the record, 'stats' or 'logs'.
+        :type stream: str
+        :param record: The record.
+        :type record: dict
+        """
+        with self.__subscription_lock:
+            subscriptions = list(self.__subscriptions)
+        for subscription in subscriptions:
+            subscription.offer(stream, record)
+
+    def monitoring_logging_start(self, console=True):
         """
         A method to start the logging and monitoring of the containers. Because the the logs() and stats() methods of
         the docker api each return a stream as a blocking generator, one thread is assigned to each stream so that both
-        the logs and the stats of an arbitrary number of containers can be iterated.
+        the logs and the stats of an arbitrary number of containers can be iterated. The records are delivered to the
+        subscribers of the manager. If SAVE_MONITORING is True, the stats are also saved in Monitoring.log, regardless
+        of the console flag.
+        :param console: A boolean to also subscribe the console output of the stats and the standard log file for the
+        logs.
+        :type console: bool
         """
+        if console and not self.__console_subscriptions:
+            self.__console_subscriptions.append(self.subscribe(print_stats_record, 'stats'))
+            self.__console_subscriptions.append(self.subscribe(log_logs_record, 'logs'))
+        if SAVE_MONITORING and self.__monitoring_file is None:
+            self.__monitoring_file = StatsFileWriter('./Monitoring.log')
+            self.__monitoring_subscription = self.subscribe(self.__monitoring_file, 'stats')
+
         # Only monitor/log for started containers
         threads = []
         for container_id in [container.id for container in self.running_containers()]:
@@ -250,65 +563,291 @@ class ContainerManager(object):
             logging_thread.start()
             monitoring_thread.start()
 
+    def monitoring_logging_stop(self):
+        """
+        A method to remove the subscribers added by monitoring_logging_start() and close Monitoring.log. The worker
+        threads keep delivering records to any other subscribers.
+        """
+        for subscription in self.__console_subscriptions:
+            self.unsubscribe(subscription)
+        self.__console_subscriptions = []
+        if self.__monitoring_file is not None:
+            self.unsubscribe(self.__monitoring_subscription)
+            self.__monitoring_file.close()
+            self.__monitoring_file = None
+            self.__monitoring_subscription = None
+
     def monitoring_worker(self, container_id):
         """
-        The worker that iterates over the stats() stream of a specific container. It produces an output similar to the
-        'docker stats' command. The output is stdout and the data can also be saved in a file, Monitoring.log, if
-        SAVE_MONITORING is True.
+        The worker that iterates over the stats() stream of a specific container. Each line is turned into a record
+        with the values of the 'docker stats' command and published to the 'stats' subscribers.
         :param container_id: The ID of the container to get the stats.
         :type container_id: str
         """
-        with open('./Monitoring.log', 'a') as outfile:
-            for line in self.docker_client.containers.get(container_id).stats(stream=True):
-                # Option to print the complete line of the stats() output, for completion.
-                if RAW_MONITORING:
-                    print line
-                stats_dict = ast.literal_eval(line)
-
-                mem_usage = np.round(np.divide(stats_dict['memory_stats']['usage'], float(np.square(1024))), decimals=2)
-                mem_limit = np.round(np.divide(stats_dict['memory_stats']['limit'], float(np.square(1024))), decimals=2)
-                mem_percentage = np.multiply(np.round(np.divide(mem_usage, mem_limit), decimals=2), 100)
-                cpu_kernel_usage = stats_dict["cpu_stats"]["cpu_usage"]["usage_in_kernelmode"]
-                cpu_total_usage = stats_dict["cpu_stats"]["system_cpu_usage"]
-                cpu_percentage = np.multiply(
-                    np.round(np.divide(float(cpu_kernel_usage), int(cpu_total_usage)), decimals=4), 100)
-                network_adapter = stats_dict['networks'].keys()[0]
-                network_usage_i = np.round(np.divide(stats_dict['networks'][network_adapter]['rx_bytes'], float(1024)),
-                                           decimals=2)
-                network_usage_o = np.round(np.divide(stats_dict['networks'][network_adapter]['tx_bytes'], float(1024)),
-                                           decimals=2)
-                try:
-                    block_i = np.round(
-                        np.divide(stats_dict['blkio_stats']['io_service_bytes_recursive'][0]['value'], float(1024)),
-                        decimals=2)
-                    block_o = np.round(
-                        np.divide(stats_dict['blkio_stats']['io_service_bytes_recursive'][1]['value'], float(1024)),
-                        decimals=2)
-                except IndexError:
-                    block_i = 0.0
-                    block_o = 0.0
-                pids = stats_dict["pids_stats"]["current"]
-
-                monitor_line = 'Container ID: {}\tCPU %: {}\tMem Usage/Limit: {} Mib/{} Mib\tMem %: {}\t' \
-                               'Net I/O: {} kB/{} kB\tBlock I/O: {} kB/{} kB\tPIDS: {}'. \
-                    format(container_id, cpu_percentage, mem_usage, mem_limit, mem_percentage,
-                           network_usage_i, network_usage_o, block_i, block_o, pids)
-                print monitor_line
-
-                if SAVE_MONITORING:
-                    outfile.write(monitor_line + '\n')
-                    outfile.flush()
+        for line in self.docker_client.containers.get(container_id).stats(stream=True):
+            self.publish('stats', stats_record(container_id, line))
 
     def logs_worker(self, container_id):
         """
-        The worker that iterates over the logs() stream of a specific container.
-        The output is saved in the standard log file.
+        The worker that iterates over the logs() stream of a specific container. Each line is published as a record to
+        the 'logs' subscribers.
         :param container_id: The ID of the container to get the stats.
         :type container_id: str
         """
         docker_container = self.docker_client.containers.get(container_id)
         for line in docker_container.logs(stdout=True, stderr=True, since=int(time.time()), stream=True):
-            logger.debug('{} : {}'.format(docker_container.name, line.strip()))
+            self.publish('logs', {'container_id': container_id, 'name': docker_container.name, 'time': time.time(),
+                                  'line': line.strip()})
+
+
+def normalize_reference(reference):
+    """
+    A function to add the default 'latest' tag to an image reference, so that 'flask' and 'flask:latest' are the same.
+    :param reference: The image reference.
+    :type reference: str
+    :return: The reference with a tag or digest.
+    :rtype: str
+    """
+    if '@' in reference:
+        return reference
+    repository, tag = parse_repository_tag(reference)
+    return '{}:{}'.format(repository, tag or 'latest')
+
+
+def dockerfile_base_images(path):
+    """
+    A function to return the images of the FROM instructions of a Dockerfile. Build stages, 'scratch' and references
+    that use build arguments are skipped.
+    :param path: The path to the folder that contains the Dockerfile.
+    :type path: str
+    :return: A list of image references.
+    :rtype: list
+    """
+    images = []
+    stages = {'scratch'}
+    try:
+        with open(os.path.join(path, 'Dockerfile')) as dockerfile:
+            for line in dockerfile:
+                words = line.split()
+                if not words or words[0].upper() != 'FROM':
+                    continue
+                words = [word for word in words[1:] if not word.startswith('--')]
+                if not words:
+                    continue
+                if words[0].lower() not in stages and '$' not in words[0] and words[0] not in images:
+                    images.append(words[0])
+                if len(words) == 3 and words[1].upper() == 'AS':
+                    stages.add(words[2].lower())
+    except IOError, e:
+        logger.warning('Unable to read the base images of the Dockerfile: {}'.format(e))
+    return images
+
+
+def stats_record(container_id, line):
+    """
+    A function to turn a line of the stats() stream into a record. Memory is in Mib, network and block I/O in kB.
+    :param container_id: The ID of the container the line belongs to.
+    :type container_id: str
+    :param line: The line of the stats() stream.
+    :type line: str
+    :return: The record.
+    :rtype: dict
+    """
+    stats_dict = ast.literal_eval(line)
+
+    mem_usage = np.round(np.divide(stats_dict['memory_stats']['usage'], float(np.square(1024))), decimals=2)
+    mem_limit = np.round(np.divide(stats_dict['memory_stats']['limit'], float(np.square(1024))), decimals=2)
+    mem_percentage = np.multiply(np.round(np.divide(mem_usage, mem_limit), decimals=2), 100)
+    cpu_kernel_usage = stats_dict["cpu_stats"]["cpu_usage"]["usage_in_kernelmode"]
+    cpu_total_usage = stats_dict["cpu_stats"]["system_cpu_usage"]
+    cpu_percentage = np.multiply(np.round(np.divide(float(cpu_kernel_usage), int(cpu_total_usage)), decimals=4), 100)
+    network_adapter = stats_dict['networks'].keys()[0]
+    network_usage_i = np.round(np.divide(stats_dict['networks'][network_adapter]['rx_bytes'], float(1024)), decimals=2)
+    network_usage_o = np.round(np.divide(stats_dict['networks'][network_adapter]['tx_bytes'], float(1024)), decimals=2)
+    try:
+        block_i = np.round(np.divide(stats_dict['blkio_stats']['io_service_bytes_recursive'][0]['value'], float(1024)),
+                           decimals=2)
+        block_o = np.round(np.divide(stats_dict['blkio_stats']['io_service_bytes_recursive'][1]['value'], float(1024)),
+                           decimals=2)
+    except IndexError:
+        block_i = 0.0
+        block_o = 0.0
+    pids = stats_dict["pids_stats"]["current"]
+
+    return {'container_id': container_id, 'cpu_percentage': cpu_percentage, 'mem_usage': mem_usage,
+            'mem_limit': mem_limit, 'mem_percentage': mem_percentage, 'network_i': network_usage_i,
+            'network_o': network_usage_o, 'block_i': block_i, 'block_o': block_o, 'pids': pids, 'raw': line}
+
+
+def format_stats_record(record):
+    """
+    A function to format a stats record similar to the output of the 'docker stats' command.
+    :param record: The stats record.
+    :type record: dict
+    :return: The formatted line.
+    :rtype: str
+    """
+    return 'Container ID: {}\tCPU %: {}\tMem Usage/Limit: {} Mib/{} Mib\tMem %: {}\t' \
+           'Net I/O: {} kB/{} kB\tBlock I/O: {} kB/{} kB\tPIDS: {}'. \
+        format(record['container_id'], record['cpu_percentage'], record['mem_usage'], record['mem_limit'],
+               record['mem_percentage'], record['network_i'], record['network_o'], record['block_i'],
+               record['block_o'], record['pids'])
+
+
+def print_stats_record(record):
+    """
+    A subscriber that prints a stats record to stdout. If RAW_MONITORING is True the raw line of the stats() stream is
+    also printed.
+    :param record: The stats record.
+    :type record: dict
+    """
+    # Option to print the complete line of the stats() output, for completion.
+    if RAW_MONITORING:
+        print record['raw']
+    print format_stats_record(record)
+
+
+def log_logs_record(record):
+    """
+    A subscriber that saves a logs record in the standard log file.
+    :param record: The logs record.
+    :type record: dict
+    """
+    logger.debug('{} : {}'.format(record['name'], record['line']))
+
+
+class StatsFileWriter(object):
+    def __init__(self, path):
+        """
+        Constructor. A subscriber that appends the formatted stats records to a file.
+        :param path: The path of the file.
+        :type path: str
+        """
+        self.path = path
+        self.outfile = open(path, 'a')
+        self.__lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.__lock:
+            if self.outfile.closed:
+                return
+            self.outfile.write(format_stats_record(record) + '\n')
+            self.outfile.flush()
+
+    def close(self):
+        """
+        A method to close the file. Records received afterwards are ignored.
+        """
+        with self.__lock:
+            self.outfile.close()
+
+
+class Subscription(object):
+    def __init__(self, stream, record_filter=None, maxsize=SUBSCRIBER_BUFFER_SIZE):
+        """
+        Constructor. A subscription to the records of a stream, with a bounded buffer. When the buffer is full the
+        oldest record is dropped, so that publishing never blocks.
+        :param stream: The stream of the subscription, 'stats' or 'logs'.
+        :type stream: str
+        :param record_filter: A function that takes a record and returns True if it should be delivered. Optional.
+        :type record_filter: function
+        :param maxsize: The number of records to buffer.
+        :type maxsize: int
+        """
+        self.stream = stream
+        self.record_filter = record_filter
+        self.maxsize = maxsize
+        # One extra slot is kept for the end of stream marker, so that closing never drops a record.
+        self.buffer = Queue.Queue(maxsize + 1)
+        self.dropped = 0
+        self.closed = False
+        self.__lock = threading.Lock()
+
+    def offer(self, stream, record):
+        """
+        A method to add a record to the buffer, if it belongs to the stream of the subscription and passes its filter.
+        A filter that raises only drops the record for this subscription, so the publisher is never interrupted.
+        :param stream: The stream of the record.
+        :type stream: str
+        :param record: The record.
+        :type record: dict
+        :return: A boolean signifying if the record was buffered.
+        :rtype: bool
+        """
+        if stream != self.stream:
+            return False
+        if self.record_filter:
+            try:
+                if not self.record_filter(record):
+                    return False
+            except Exception:
+                logger.exception('Error in the filter {} of a {} subscriber.'.format(self.record_filter, self.stream))
+                return False
+        with self.__lock:
+            if self.closed:
+                return False
+            while self.buffer.qsize() >= self.maxsize:
+                try:
+                    self.buffer.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty:
+                    break
+            self.buffer.put_nowait(record)
+        return True
+
+    def close(self):
+        """
+        A method to close the subscription. The records already buffered can still be read.
+        """
+        with self.__lock:
+            if not self.closed:
+                self.closed = True
+                self.buffer.put_nowait(_END_OF_STREAM)
+
+    def __iter__(self):
+        while True:
+            # Waiting with a timeout, as a blocking get() cannot be interrupted by Ctrl-C in Python 2.
+            try:
+                record = self.buffer.get(timeout=SUBSCRIBER_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            if record is _END_OF_STREAM:
+                return
+            yield record
+
+
+class SubscriptionIterator(object):
+    def __init__(self, container_manager, subscription):
+        """
+        Constructor. An iterator over the records of a subscription, that removes the subscription from the manager
+        when it is closed, exhausted or garbage collected, even if it was never iterated.
+        :param container_manager: The manager the subscription belongs to.
+        :type container_manager: ContainerManager
+        :param subscription: The subscription to iterate.
+        :type subscription: Subscription
+        """
+        self.container_manager = container_manager
+        self.subscription = subscription
+        self.__records = iter(subscription)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self.__records)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        A method to remove the subscription. The records already buffered can still be read.
+        """
+        self.container_manager.unsubscribe(self.subscription)
+
+    def __del__(self):
+        self.close()
 
 
 class DockerImage(object):
@@ -336,8 +875,355 @@ class DockerImage(object):
             self.created_successfully = False
 
 
+class PulledImage(object):
+    def __init__(self, docker_image_obj, reference):
+        """
+        Constructor. It wraps an image that was pulled by an ImagePull, with the same attributes as DockerImage.
+        :param docker_image_obj: The image object of the docker api.
+        :type docker_image_obj: Image
+        :param reference: The reference the image was pulled with.
+        :type reference: str
+        """
+        self.docker_image_obj = docker_image_obj
+        self.short_id = docker_image_obj.short_id
+        self.id = docker_image_obj.id
+        self.tag = reference
+        self.created_successfully = True
+
+
+class ResourceProfile(object):
+    def __init__(self, cpus=None, cpu_quota=None, cpu_period=None, cpuset_cpus=None, mem_limit=None):
+        """
+        Constructor. A set of CPU and memory limits to apply to a container on creation.
+        :param cpus: The number of host cores to pin the container to. They are chosen by the CoreAllocator.
+        :type cpus: int
+        :param cpu_quota: The CPU time in microseconds the container can use per cpu_period.
+        :type cpu_quota: int
+        :param cpu_period: The length of a CPU period in microseconds. Docker defaults to 100000.
+        :type cpu_period: int
+        :param cpuset_cpus: An explicit set of cores to use, e.g. '0-1' or '0,3'. It bypasses the CoreAllocator.
+        :type cpuset_cpus: str
+        :param mem_limit: The memory limit, as bytes or a string with a unit, e.g. '512m'.
+        :type mem_limit: int || str
+        """
+        self.cpus = cpus
+        self.cpu_quota = cpu_quota
+        self.cpu_period = cpu_period
+        self.cpuset_cpus = cpuset_cpus
+        self.mem_limit = mem_limit
+
+    def create_kwargs(self, cores=None, core_allocator=None):
+        """
+        A method to return the arguments to pass to docker_client.containers.create() for this profile.
+        :param cores: The cores assigned to the container by the CoreAllocator. Optional.
+        :type cores: list
+        :param core_allocator: The allocator the cores came from, to also pin the memory of their NUMA node. Optional.
+        :type core_allocator: CoreAllocator
+        :return: A dictionary of keyword arguments.
+        :rtype: dict
+        """
+        kwargs = {'cpu_quota': self.cpu_quota, 'cpu_period': self.cpu_period, 'cpuset_cpus': self.cpuset_cpus,
+                  'mem_limit': self.mem_limit}
+        if cores:
+            kwargs['cpuset_cpus'] = CoreAllocator.cpuset(cores)
+            if core_allocator:
+                kwargs['cpuset_mems'] = core_allocator.cpuset_mems(cores)
+        return dict((key, value) for key, value in kwargs.items() if value is not None)
+
+
+class CoreAllocator(object):
+    def __init__(self, core_count, numa_nodes=1):
+        """
+        Constructor. It keeps track of which host cores are assigned to which container, so that replicas are spread
+        evenly across the cores and NUMA nodes instead of all competing for every core.
+        :param core_count: The number of cores of the docker host.
+        :type core_count: int
+        :param numa_nodes: The number of NUMA nodes. The cores are split evenly into contiguous nodes.
+        :type numa_nodes: int
+        """
+        self.core_count = max(int(core_count), 1)
+        self.numa_nodes = min(max(int(numa_nodes), 1), self.core_count)
+        self.nodes = [[int(core) for core in node] for node in
+                      np.array_split(np.arange(self.core_count), self.numa_nodes)]
+        self.__assignments = {}
+        self.__pinned = set()
+
+    @staticmethod
+    def cpuset(cores):
+        """
+        A method to format a list of cores the way docker expects it for cpuset_cpus.
+        :param cores: The core numbers.
+        :type cores: list
+        :return: The cores as a comma separated string, e.g. '0,2'.
+        :rtype: str
+        """
+        return ','.join(str(core) for core in sorted(cores))
+
+    @staticmethod
+    def parse_cpuset(cpuset):
+        """
+        A method to turn a cpuset_cpus string into a list of cores.
+        :param cpuset: The cores as docker expects them, e.g. '0-2,5'.
+        :type cpuset: str
+        :return: The core numbers.
+        :rtype: list
+        """
+        cores = set()
+        for part in str(cpuset).split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '-' in part:
+                first, last = part.split('-', 1)
+                cores.update(range(int(first), int(last) + 1))
+            else:
+                cores.add(int(part))
+        return sorted(cores)
+
+    def cpuset_mems(self, cores):
+        """
+        A method to return the NUMA nodes of a list of cores the way docker expects them for cpuset_mems.
+        :param cores: The core numbers.
+        :type cores: list
+        :return: The nodes as a comma separated string, or None if the host has a single node.
+        :rtype: str || None
+        """
+        if self.numa_nodes <= 1:
+            return None
+        return ','.join(str(node) for node in sorted(set(self.node_of(core) for core in cores)))
+
+    def node_of(self, core):
+        """
+        A method to return the NUMA node a core belongs to.
+        :param core: The core number.
+        :type core: int
+        :return: The index of the node.
+        :rtype: int
+        """
+        for index, node in enumerate(self.nodes):
+            if core in node:
+                return index
+        raise ValueError('Core {} does not exist on this host.'.format(core))
+
+    def core_load(self):
+        """
+        A method to return the number of containers assigned to each core.
+        :return: A dictionary core:number of containers.
+        :rtype: dict
+        """
+        load = dict((core, 0) for core in range(self.core_count))
+        for cores in self.__assignments.values():
+            for core in cores:
+                load[core] += 1
+        return load
+
+    def assignments(self):
+        """
+        A method to return the current assignments of cores to containers.
+        :return: A dictionary container_id:list of cores.
+        :rtype: dict
+        """
+        return dict((container_id, list(cores)) for container_id, cores in self.__assignments.items())
+
+    def allocate(self, cpus=1):
+        """
+        A method to choose the cores for a new container, without assigning them yet. The least loaded NUMA node that
+        is large enough is chosen, and within it the least loaded cores.
+        :param cpus: The number of cores the container needs.
+        :type cpus: int
+        :return: The chosen cores.
+        :rtype: list
+        """
+        cpus = min(max(int(cpus), 1), self.core_count)
+        load = self.core_load()
+        candidates = [node for node in self.nodes if len(node) >= cpus] or [range(self.core_count)]
+        node = min(candidates, key=lambda cores: np.mean([load[core] for core in cores]))
+        return sorted(sorted(node, key=lambda core: load[core])[:cpus])
+
+    def assign(self, container_id, cores, pinned=False):
+        """
+        A method to record the cores that were given to a container. Cores that do not exist on the host are ignored.
+        :param container_id: The ID of the container.
+        :type container_id: str
+        :param cores: The cores of the container.
+        :type cores: list
+        :param pinned: A boolean signifying that the cores were chosen explicitly, so rebalance() must not move them.
+        :type pinned: bool
+        """
+        self.__assignments[container_id] = sorted(core for core in cores if 0 <= core < self.core_count)
+        if pinned:
+            self.__pinned.add(container_id)
+        else:
+            self.__pinned.discard(container_id)
+
+    def release(self, container_id):
+        """
+        A method to free the cores of a container.
+        :param container_id: The ID of the container.
+        :type container_id: str
+        :return: A boolean signifying if the container had cores assigned.
+        :rtype: bool
+        """
+        self.__pinned.discard(container_id)
+        return self.__assignments.pop(container_id, None) is not None
+
+    def rebalance(self):
+        """
+        A method to move containers from the busiest cores to the idlest ones, until no two cores differ by more than
+        one container, or no more moves are possible. Moves within the same NUMA node are preferred and pinned
+        containers are never moved.
+        :return: A dictionary container_id:list of cores of the containers that were moved.
+        :rtype: dict
+        """
+        moved = {}
+        while True:
+            move = self.__find_move(self.core_load())
+            if move is None:
+                break
+            container_id, busy_core, target = move
+            cores = self.__assignments[container_id]
+            self.__assignments[container_id] = sorted([core for core in cores if core != busy_core] + [target])
+            moved[container_id] = self.__assignments[container_id]
+        return moved
+
+    def __find_move(self, load):
+        for busy_core in sorted(range(self.core_count), key=lambda core: (-load[core], core)):
+            for container_id in sorted(self.__assignments):
+                cores = self.__assignments[container_id]
+                if container_id in self.__pinned or busy_core not in cores or len(cores) == self.core_count:
+                    continue
+                target = min([core for core in range(self.core_count) if core not in cores],
+                             key=lambda core: (load[core], self.node_of(core) != self.node_of(busy_core), core))
+                if load[busy_core] - load[target] > 1:
+                    return container_id, busy_core, target
+        return None
+
+
+class ImagePull(object):
+    def __init__(self, docker_client, reference, publish=None, force=False):
+        """
+        Constructor. The pull of an image, that runs in a separate thread once start() is called. If the image is
+        already available locally it is not pulled, unless force is True.
+        :param docker_client: The client object.
+        :type docker_client: DockerClient
+        :param reference: The image to pull, with a tag or digest.
+        :type reference: str
+        :param publish: A function that is called with a record of every progress update of a layer. Optional.
+        :type publish: function
+        :param force: A boolean to pull the image even if it is available locally.
+        :type force: bool
+        """
+        self.docker_client = docker_client
+        self.reference = reference
+        self.publish = publish
+        self.force = force
+        self.layers = {}
+        self.image = None
+        self.error = None
+        self.__done = threading.Event()
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        A method to start pulling the image.
+        """
+        pull_thread = threading.Thread(target=self.__pull_worker)
+        pull_thread.daemon = True
+        pull_thread.start()
+
+    def done(self):
+        """
+        A method to check if the pull finished, successfully or not.
+        :return: A boolean signifying if the pull finished.
+        :rtype: bool
+        """
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        A method to wait for the pull to finish.
+        :param timeout: The maximum number of seconds to wait. If none, wait until the pull finishes.
+        :type timeout: float
+        :return: A boolean signifying if the image was pulled successfully.
+        :rtype: bool
+        """
+        self.__done.wait(timeout)
+        return self.image is not None
+
+    def add_done_callback(self, callback):
+        """
+        A method to call a function with this pull when it finishes, before wait() returns. If it already finished, it
+        is called immediately.
+        :param callback: A function that takes the ImagePull as its only argument.
+        :type callback: function
+        """
+        with self.__lock:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def progress(self):
+        """
+        A method to return the total progress of the layers that reported their size.
+        :return: A tuple of (bytes done, bytes total).
+        :rtype: tuple
+        """
+        layers = self.layers.values()
+        return sum(layer['current'] for layer in layers), sum(layer['total'] for layer in layers)
+
+    def __pull_worker(self):
+        repository, tag = parse_repository_tag(self.reference)
+        try:
+            if not self.force:
+                try:
+                    self.image = self.docker_client.images.get(self.reference)
+                    logger.debug('Image: {} is already available locally.'.format(self.reference))
+                    return
+                except ImageNotFound:
+                    pass
+            logger.info('Pulling image: {}'.format(self.reference))
+            for event in self.docker_client.api.pull(repository, tag=tag, stream=True, decode=True):
+                if 'error' in event:
+                    raise APIError(event['error'])
+                # Skipping the events that are not about a layer, e.g. 'Pulling from' whose id is the tag.
+                if 'id' in event and 'progressDetail' in event and event['id'] != tag:
+                    self.__layer_progress(event)
+            self.image = self.docker_client.images.get(self.reference)
+            logger.info('Image: {} pulled successfully.'.format(self.reference))
+        except Exception, e:
+            # Any failure, e.g. a refused connection to the registry, must be recorded so the pull can be retried.
+            self.error = e
+            logger.warning('Pulling image: {} failed with error message: {}'.format(self.reference, e))
+        finally:
+            # Running the callbacks before the pull is marked as done, so that wait() returns after they ran, e.g.
+            # after the pulled image was registered by the manager.
+            while True:
+                with self.__lock:
+                    callbacks, self.__callbacks = self.__callbacks, []
+                    if not callbacks:
+                        self.__done.set()
+                        break
+                for callback in callbacks:
+                    try:
+                        callback(self)
+                    except Exception:
+                        logger.exception('Error in the done callback of the pull of image: {}'.format(self.reference))
+
+    def __layer_progress(self, event):
+        detail = event.get('progressDetail') or {}
+        layer = self.layers.setdefault(event['id'], {'status': '', 'current': 0, 'total': 0})
+        layer['status'] = event['status']
+        layer['current'] = detail.get('current', layer['current'])
+        layer['total'] = detail.get('total', layer['total'])
+        if self.publish:
+            self.publish({'reference': self.reference, 'layer': event['id'], 'status': layer['status'],
+                          'current': layer['current'], 'total': layer['total']})
+
+
 class DockerContainer(object):
-    def __init__(self, docker_client, image, name='', port=5000):
+    def __init__(self, docker_client, image, name='', port=5000, resources=None):
         """
         Constructor. it calls docker_client.containers.create() to create the docker container without starting it.
         :param docker_client: The client object.
@@ -348,16 +1234,23 @@ class DockerContainer(object):
         :type name: str
         :param port: The port to that the web_app inside the container will use.
         :type port: str
+        :param resources: The CPU and memory arguments of docker_client.containers.create(). Optional.
+        :type resources: dict
         """
         self.created_successfully = False
+        resources = resources or {}
+        self.cpuset = resources.get('cpuset_cpus')
+        self.cpuset_mems = resources.get('cpuset_mems')
 
         # Creating the container.
         logger.info('Creating container.')
         try:
             if name:
-                self.container_obj = docker_client.containers.create(image, detach=True, name=name, ports={5000: port})
+                self.container_obj = docker_client.containers.create(image, detach=True, name=name, ports={5000: port},
+                                                                     **resources)
             else:
-                self.container_obj = docker_client.containers.create(image, detach=True, ports={5000: port})
+                self.container_obj = docker_client.containers.create(image, detach=True, ports={5000: port},
+                                                                     **resources)
             self.short_id = self.container_obj.short_id
             self.id = self.container_obj.id
             self.name = self.container_obj.name
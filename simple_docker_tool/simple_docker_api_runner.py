@@ -5,7 +5,7 @@ import logging
 import logging.config
 import sys
 
-from simple_docker_api.container_manager import ContainerManager
+from simple_docker_api.container_manager import ContainerManager, ResourceProfile
 
 __author__ = 'Nikitas Papangelopoulos'
 
@@ -15,7 +15,7 @@ logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 
 
-def main(image_name, container_number, container_ports, container_names):
+def main(image_name, container_number, container_ports, container_names, resource_profile=None):
     # Creating a ContainerManager
     cm = ContainerManager()
     image = cm.build_image('docker_image_files', image_name)
@@ -27,9 +27,10 @@ def main(image_name, container_number, container_ports, container_names):
     # Creating the containers
     for i in range(container_number):
         if use_custom_names:
-            cm.create_container(image.id, name=container_names[i], port=container_ports[i])
+            cm.create_container(image.id, name=container_names[i], port=container_ports[i],
+                                resource_profile=resource_profile)
         else:
-            cm.create_container(image.id, port=container_ports[i])
+            cm.create_container(image.id, port=container_ports[i], resource_profile=resource_profile)
 
     # Checking that all containers were created successfully
     all_success = all([container.created_successfully for container in cm.available_containers().values()])
@@ -61,6 +62,13 @@ if __name__ == '__main__':
                         help='The port that each container should use. Must be same as the number of containers.')
     parser.add_argument('-names', '--container-names', type=list, default=[],
                         help='The name of the containers to be created. If none, auto-generated names will be used.')
+    parser.add_argument('-cpus', '--container-cpus', type=int, default=None,
+                        help='The number of host cores to pin each container to. The cores are spread evenly across '
+                             'the host. If none, the containers can use every core.')
+    parser.add_argument('-quota', '--cpu-quota', type=int, default=None,
+                        help='The CPU time in microseconds each container can use per 100000 microseconds.')
+    parser.add_argument('-mem', '--mem-limit', type=str, default=None,
+                        help='The memory limit of each container, e.g. 512m. If none, there is no limit.')
     args = parser.parse_args()
 
     wrong_input = False
@@ -76,4 +84,8 @@ if __name__ == '__main__':
         logger.error('Number of containers, ports and names must be the same.')
         sys.exit(-1)
 
-    main(args.image_name, args.container_number, args.container_ports, args.container_names)
+    profile = None
+    if args.container_cpus or args.cpu_quota or args.mem_limit:
+        profile = ResourceProfile(cpus=args.container_cpus, cpu_quota=args.cpu_quota, mem_limit=args.mem_limit)
+
+    main(args.image_name, args.container_number, args.container_ports, args.container_names, profile)
@@ -1,18 +1,36 @@
 #!/usr/bin/python
 
+import gc
 import logging.config
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
 from mock import MagicMock, patch
 from docker.errors import *
 
-from simple_docker_tool.simple_docker_api.container_manager import ContainerManager, DockerImage, DockerContainer
+from simple_docker_tool.simple_docker_api.container_manager import ContainerManager, DockerImage, DockerContainer, \
+    CoreAllocator, ResourceProfile, Subscription, format_stats_record, dockerfile_base_images, normalize_reference
 
 __author__ = 'Nikitas Papangelopoulos'
 
 #logging.config.fileConfig('../logging.conf', disable_existing_loggers=False)
 
+# The events of a pull from a local registry, as decoded by docker_client.api.pull().
+PULL_EVENTS = [{'status': 'Pulling from flask', 'id': 'latest'},
+               {'status': 'Downloading', 'id': 'layer_1', 'progressDetail': {'current': 512, 'total': 1024}},
+               {'status': 'Downloading', 'id': 'layer_1', 'progressDetail': {'current': 1024, 'total': 1024}},
+               {'status': 'Pull complete', 'id': 'layer_1', 'progressDetail': {}},
+               {'status': 'Status: Downloaded newer image for localhost:5000/flask:latest'}]
+
+STATS_LINE = str({'memory_stats': {'usage': 52428800, 'limit': 104857600},
+                  'cpu_stats': {'cpu_usage': {'usage_in_kernelmode': 25}, 'system_cpu_usage': 100},
+                  'networks': {'eth0': {'rx_bytes': 2048, 'tx_bytes': 1024}},
+                  'blkio_stats': {'io_service_bytes_recursive': []}, 'pids_stats': {'current': 3}})
+
 
 class TestContainerManager(unittest.TestCase):
 
@@ -24,6 +42,7 @@ class TestContainerManager(unittest.TestCase):
         mock_client.containers.create.return_value = MagicMock(short_id='mock_cont_short_id', id='mock_cont_id',
                                                                status='created', created_successfully=True)
         mock_client.containers.create().name = 'mock_container'
+        mock_client.info.return_value = {'NCPU': 4}
 
         self.mock_client = mock_client
         self.cm.docker_client = self.mock_client
@@ -202,3 +221,340 @@ class TestContainerManager(unittest.TestCase):
         self.cm.docker_client.containers.list.return_value = [container]
         containers = self.cm.running_containers_on_server()
         self.assertEqual(len(containers), 1)
+
+    def test_create_container_resource_profile(self):
+        profile = ResourceProfile(cpus=1, cpu_quota=50000, mem_limit='256m')
+        container = self.cm.create_container('mock_img_short_id', 'mock_container', port=5000,
+                                             resource_profile=profile)
+        self.assertEqual(container.cpuset, '0')
+        self.mock_client.containers.create.assert_called_with('mock_img_short_id', detach=True, name='mock_container',
+                                                              ports={5000: 5000}, cpu_quota=50000, mem_limit='256m',
+                                                              cpuset_cpus='0')
+        self.assertEqual(self.cm.core_allocator().assignments(), {'mock_cont_id': [0]})
+
+    def test_create_container_explicit_cpuset(self):
+        container = self.cm.create_container('mock_img_short_id', resource_profile=ResourceProfile(cpuset_cpus='2-3'))
+        self.assertEqual(container.cpuset, '2-3')
+        allocator = self.cm.core_allocator()
+        self.assertEqual(allocator.assignments(), {'mock_cont_id': [2, 3]})
+        # The pinned cores are no longer idle for new containers and are never moved.
+        self.assertEqual(allocator.allocate(2), [0, 1])
+        allocator.assign('cont_a', [2])
+        self.assertEqual(allocator.rebalance(), {'cont_a': [0]})
+        self.assertEqual(allocator.assignments()['mock_cont_id'], [2, 3])
+
+    def test_remove_container_rebalance(self):
+        self.mock_client.info.return_value = {'NCPU': 3}
+        others = {'cont_a': [1], 'cont_b': [1], 'cont_c': [2], 'cont_d': [2]}
+        with patch.dict(self.cm._ContainerManager__container_dict, dict((key, MagicMock()) for key in others)):
+            allocator = self.cm.core_allocator()
+            for container_id, cores in others.items():
+                allocator.assign(container_id, cores)
+            container = self.cm.create_container('mock_img_short_id', port=5000,
+                                                 resource_profile=ResourceProfile(cpus=1))
+            self.assertEqual(container.cpuset, '0')
+            self.assertTrue(self.cm.remove_container('mock_cont_id'))
+            self.assertEqual(allocator.assignments()['cont_a'], [0])
+            self.mock_client.containers.get('cont_a').update.assert_called_with(cpuset_cpus='0')
+            self.assertEqual(self.cm.get_container('cont_a').cpuset, '0')
+
+    def test_rebalance_containers_fail(self):
+        allocator = self.cm.core_allocator()
+        allocator.assign('cont_a', [0])
+        allocator.assign('cont_b', [0])
+        self.mock_client.containers.get('cont_a').update.side_effect = APIError('')
+        self.assertEqual(self.cm.rebalance_containers(), {})
+        self.assertEqual(allocator.assignments(), {'cont_a': [0], 'cont_b': [0]})
+
+        # Containers of the allocator that are not managed are moved without a KeyError.
+        self.mock_client.containers.get('cont_a').update.side_effect = None
+        self.assertEqual(self.cm.rebalance_containers(), {'cont_a': '1'})
+        self.assertEqual(allocator.assignments()['cont_a'], [1])
+
+    @mock.patch('simple_docker_tool.simple_docker_api.container_manager.NUMA_NODES', 2)
+    def test_rebalance_containers_numa(self):
+        self.mock_client.info.return_value = {'NCPU': 2}
+        container = self.cm.create_container('mock_img_short_id', port=5000, resource_profile=ResourceProfile(cpus=1))
+        self.assertEqual((container.cpuset, container.cpuset_mems), ('0', '0'))
+        with patch.dict(self.cm._ContainerManager__container_dict, {'cont_a': MagicMock(), 'cont_b': MagicMock()}):
+            allocator = self.cm.core_allocator()
+            allocator.assign('cont_a', [0], pinned=True)
+            allocator.assign('cont_b', [0], pinned=True)
+            self.assertEqual(self.cm.rebalance_containers(), {'mock_cont_id': '1'})
+            self.mock_client.containers.get('mock_cont_id').update.assert_called_with(cpuset_cpus='1', cpuset_mems='1')
+            self.assertEqual((container.cpuset, container.cpuset_mems), ('1', '1'))
+
+    def test_CoreAllocator_parse_cpuset(self):
+        self.assertEqual(CoreAllocator.parse_cpuset('0-2,5'), [0, 1, 2, 5])
+        self.assertEqual(CoreAllocator.parse_cpuset('3'), [3])
+
+    def test_CoreAllocator_allocate(self):
+        allocator = CoreAllocator(4, numa_nodes=2)
+        self.assertEqual(allocator.nodes, [[0, 1], [2, 3]])
+        for i in range(4):
+            allocator.assign('cont_{}'.format(i), allocator.allocate())
+        self.assertEqual(allocator.core_load(), {0: 1, 1: 1, 2: 1, 3: 1})
+        self.assertEqual(allocator.allocate(2), [0, 1])
+        self.assertEqual(allocator.allocate(3), [0, 1, 2])
+
+    def test_CoreAllocator_rebalance(self):
+        allocator = CoreAllocator(4, numa_nodes=2)
+        for i in range(4):
+            allocator.assign('cont_{}'.format(i), [0])
+        moved = allocator.rebalance()
+        self.assertEqual(len(moved), 3)
+        self.assertEqual(sorted(allocator.core_load().values()), [1, 1, 1, 1])
+        self.assertEqual(allocator.rebalance(), {})
+        self.assertTrue(allocator.release('cont_0'))
+        self.assertFalse(allocator.release('cont_0'))
+
+    def test_ResourceProfile_create_kwargs(self):
+        allocator = CoreAllocator(4, numa_nodes=2)
+        profile = ResourceProfile(cpus=2, cpu_period=100000, cpu_quota=200000, mem_limit='1g')
+        self.assertEqual(profile.create_kwargs([3, 2], allocator),
+                         {'cpu_period': 100000, 'cpu_quota': 200000, 'mem_limit': '1g', 'cpuset_cpus': '2,3',
+                          'cpuset_mems': '1'})
+        self.assertEqual(ResourceProfile().create_kwargs(), {})
+
+    def test_iter_stats_success(self):
+        self.mock_client.containers.get().stats.return_value = [STATS_LINE, STATS_LINE]
+        stats = self.cm.iter_stats('mock_cont_id')
+        self.cm.monitoring_worker('mock_cont_id')
+        record = next(stats)
+        self.assertEqual(record['container_id'], 'mock_cont_id')
+        self.assertEqual(record['cpu_percentage'], 25.0)
+        self.assertEqual(record['mem_usage'], 50.0)
+        self.assertEqual(record['mem_percentage'], 50.0)
+        self.assertEqual(record['network_i'], 2.0)
+        self.assertEqual(record['block_i'], 0.0)
+        self.assertEqual(record['pids'], 3)
+        self.assertIn('Mem Usage/Limit: 50.0 Mib/100.0 Mib', format_stats_record(record))
+        stats.close()
+        self.assertEqual(self.cm._ContainerManager__subscriptions, [])
+
+    def test_iter_logs_filter(self):
+        self.mock_client.containers.get().logs.return_value = ['hello\n']
+        self.mock_client.containers.get().name = 'mock_container'
+        other_logs = self.cm.iter_logs('other_cont_id')
+        logs = self.cm.iter_logs('mock_cont_id')
+        self.cm.logs_worker('mock_cont_id')
+        record = next(logs)
+        self.assertEqual((record['name'], record['line']), ('mock_container', 'hello'))
+        subscriptions = self.cm._ContainerManager__subscriptions
+        self.assertTrue(subscriptions[0].buffer.empty())
+        other_logs.close()
+        self.assertEqual(len(subscriptions), 1)
+        del logs
+        gc.collect()
+        self.assertEqual(subscriptions, [])
+
+    def test_subscribe_callback(self):
+        received = []
+        done = threading.Event()
+
+        def callback(record):
+            received.append(record)
+            done.set()
+
+        subscription = self.cm.subscribe(callback, 'logs')
+        self.cm.publish('stats', {'container_id': 'mock_cont_id'})
+        self.cm.publish('logs', {'container_id': 'mock_cont_id', 'line': 'hello'})
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [{'container_id': 'mock_cont_id', 'line': 'hello'}])
+        self.assertTrue(self.cm.unsubscribe(subscription))
+        self.assertFalse(self.cm.unsubscribe(subscription))
+        self.assertRaises(ValueError, self.cm.subscribe, callback, 'events')
+
+    def test_monitoring_logging_stop(self):
+        path = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.chdir(path)
+            self.cm.monitoring_logging_start(console=False)
+            subscriptions = self.cm._ContainerManager__subscriptions
+            self.assertEqual([subscription.stream for subscription in subscriptions], ['stats'])
+            writer = self.cm._ContainerManager__monitoring_file
+            self.cm.monitoring_logging_stop()
+            self.assertEqual(subscriptions, [])
+            self.assertTrue(writer.outfile.closed)
+            writer({'container_id': 'mock_cont_id'})
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(path)
+
+    def test_subscribe_faulty_filter(self):
+        faulty = self.cm.subscribe(stream='logs', record_filter=lambda record: record['missing_key'])
+        logs = self.cm.subscribe(stream='logs')
+        self.cm.publish('logs', {'container_id': 'mock_cont_id', 'line': 'hello'})
+        self.assertTrue(faulty.buffer.empty())
+        self.assertEqual(logs.buffer.get_nowait()['line'], 'hello')
+
+    @mock.patch('simple_docker_tool.simple_docker_api.container_manager.SUBSCRIBER_POLL_INTERVAL', 0.01)
+    def test_Subscription_poll(self):
+        subscription = Subscription('stats')
+        closer = threading.Timer(0.05, subscription.close)
+        closer.start()
+        self.assertEqual(list(subscription), [])
+        closer.join()
+
+    def test_Subscription_bounded_buffer(self):
+        subscription = Subscription('stats', maxsize=2)
+        for i in range(5):
+            subscription.offer('stats', i)
+        self.assertEqual(subscription.dropped, 3)
+        subscription.close()
+        self.assertEqual(list(subscription), [3, 4])
+
+    def fake_registry(self, local_images=(), events=PULL_EVENTS, release=None, pull_error=None):
+        """
+        Replaces the pull and get of images of the mock client with a stand-in for a local registry. The images in
+        local_images, and those pulled, are returned by images.get(). The returned set can be changed to remove images.
+        """
+        local_images = set(local_images)
+
+        def get(reference):
+            if reference not in local_images:
+                raise ImageNotFound(reference)
+            return MagicMock(id=reference + '_id', short_id=reference)
+
+        def pull(repository, tag=None, stream=False, decode=False):
+            if release:
+                release.wait(5)
+            if pull_error:
+                raise pull_error
+            local_images.add('{}:{}'.format(repository, tag))
+            return iter(events)
+
+        self.mock_client.images.get.side_effect = get
+        self.mock_client.api.pull.side_effect = pull
+        return local_images
+
+    def test_pull_image_success(self):
+        self.fake_registry()
+        progress = self.cm.subscribe(stream='pulls')
+        pull = self.cm.pull_image('localhost:5000/flask')
+        self.assertTrue(pull.wait(5))
+        self.mock_client.api.pull.assert_called_with('localhost:5000/flask', tag='latest', stream=True, decode=True)
+        self.assertEqual(pull.image.id, 'localhost:5000/flask:latest_id')
+        self.assertEqual(pull.layers.keys(), ['layer_1'])
+        self.assertEqual(pull.layers['layer_1'], {'status': 'Pull complete', 'current': 1024, 'total': 1024})
+        self.assertEqual(pull.progress(), (1024, 1024))
+        record = progress.buffer.get_nowait()
+        self.assertEqual((record['reference'], record['layer']), ('localhost:5000/flask:latest', 'layer_1'))
+        # A successful pull is not repeated.
+        self.assertIs(self.cm.pull_image('localhost:5000/flask:latest'), pull)
+
+    def test_pull_image_removed(self):
+        local_images = self.fake_registry()
+        pull = self.cm.pull_image('localhost:5000/flask')
+        self.assertTrue(pull.wait(5))
+        local_images.clear()
+        retry = self.cm.pull_image('localhost:5000/flask')
+        self.assertIsNot(retry, pull)
+        self.assertTrue(retry.wait(5))
+        self.assertEqual(self.mock_client.api.pull.call_count, 2)
+
+    def test_pull_image_registered(self):
+        self.fake_registry()
+        pull = self.cm.pull_image('localhost:5000/flask')
+        self.assertTrue(pull.wait(5))
+        image = self.cm.get_image('localhost:5000/flask:latest_id')
+        self.assertEqual((image.tag, image.docker_image_obj), ('localhost:5000/flask:latest', pull.image))
+        self.assertTrue(self.cm.remove_image('localhost:5000/flask:latest_id'))
+        self.assertEqual(self.cm.available_images(), {})
+        self.assertIsNot(self.cm.pull_image('localhost:5000/flask'), pull)
+
+    def test_pull_image_local(self):
+        self.fake_registry(local_images=['flask:latest'])
+        pull = self.cm.pull_image('flask')
+        self.assertTrue(pull.wait(5))
+        self.assertFalse(self.mock_client.api.pull.called)
+        self.assertTrue(self.cm.pull_image('flask', force=True).wait(5))
+        self.assertEqual(self.mock_client.api.pull.call_count, 1)
+
+    def test_warm_images_deduplicate(self):
+        release = threading.Event()
+        self.fake_registry(events=[], release=release)
+        pulls = self.cm.warm_images(['localhost:5000/flask', 'localhost:5000/flask:latest', 'localhost:5000/redis'])
+        self.assertIs(pulls['localhost:5000/flask'], pulls['localhost:5000/flask:latest'])
+        self.assertIs(self.cm.pull_image('localhost:5000/redis', force=True), pulls['localhost:5000/redis'])
+        release.set()
+        self.assertTrue(all(pull.wait(5) for pull in pulls.values()))
+        self.assertEqual(self.mock_client.api.pull.call_count, 2)
+
+    def test_pull_image_fail(self):
+        self.fake_registry(events=[{'error': 'manifest unknown'}])
+        pull = self.cm.pull_image('localhost:5000/missing')
+        self.assertFalse(pull.wait(5))
+        self.assertIsInstance(pull.error, APIError)
+        self.assertIsNot(self.cm.pull_image('localhost:5000/missing'), pull)
+
+    def test_pull_image_connection_error(self):
+        self.fake_registry(pull_error=IOError('Connection refused'))
+        pull = self.cm.pull_image('localhost:5000/flask')
+        self.assertFalse(pull.wait(5))
+        self.assertIsInstance(pull.error, IOError)
+        self.fake_registry()
+        retry = self.cm.pull_image('localhost:5000/flask')
+        self.assertIsNot(retry, pull)
+        self.assertTrue(retry.wait(5))
+
+    def test_create_container_when_ready(self):
+        self.fake_registry()
+        created = []
+        ready = threading.Event()
+
+        def callback(container):
+            created.append(container)
+            ready.set()
+
+        self.cm.create_container_when_ready('localhost:5000/flask', 'mock_container', port=5000, callback=callback)
+        self.assertTrue(ready.wait(5))
+        self.assertEqual(created[0].id, 'mock_cont_id')
+        self.mock_client.containers.create.assert_called_with('localhost:5000/flask:latest_id', detach=True,
+                                                              name='mock_container', ports={5000: 5000})
+
+    def test_create_container_concurrent_placement(self):
+        self.mock_client.info.return_value = {'NCPU': 8}
+        self.mock_client.containers.create.side_effect = \
+            lambda image, **kwargs: MagicMock(id='cont_{}'.format(kwargs['name']), status='created')
+        threads = [threading.Thread(target=self.cm.create_container,
+                                    args=('mock_img_short_id', str(i), 5000, ResourceProfile(cpus=1)))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        cpusets = [container.cpuset for container in self.cm.available_containers().values()]
+        self.assertEqual(sorted(cpusets), [str(core) for core in range(8)])
+        self.assertFalse(self.mock_client.containers.get().update.called)
+
+    def test_build_image_warm_base_images(self):
+        self.fake_registry(local_images=['python:2.7'], pull_error=APIError('Connection refused'))
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'Dockerfile'), 'w') as dockerfile:
+                dockerfile.write('FROM python:2.7\nFROM localhost:5000/base\n')
+            with patch('simple_docker_tool.simple_docker_api.container_manager.logger') as mock_logger:
+                image = self.cm.build_image(path, 'flask')
+            self.assertTrue(image.created_successfully)
+            self.mock_client.api.pull.assert_called_once_with('localhost:5000/base', tag='latest', stream=True,
+                                                              decode=True)
+            mock_logger.warning.assert_any_call('Unable to warm base image: localhost:5000/base, the build will pull '
+                                                'it itself.')
+            self.assertFalse(mock_logger.error.called)
+        finally:
+            shutil.rmtree(path)
+
+    def test_dockerfile_base_images(self):
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'Dockerfile'), 'w') as dockerfile:
+                dockerfile.write('FROM python:2.7 AS builder\nRUN pip install flask\nFROM builder\n'
+                                 'FROM --platform=linux/amd64 localhost:5000/base\nFROM scratch\nFROM $BASE\n')
+            self.assertEqual(dockerfile_base_images(path), ['python:2.7', 'localhost:5000/base'])
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(dockerfile_base_images('missing_folder'), [])
+        self.assertEqual(normalize_reference('flask'), 'flask:latest')
+        self.assertEqual(normalize_reference('flask@sha256:abc'), 'flask@sha256:abc')